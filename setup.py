@@ -8,4 +8,5 @@ setup(name='synched_objects',
       author_email='serrari.med@hotmail.com',
       license='MIT',
       packages=['synched_objects'],
+      extras_require={'fast': ['orjson']},
       zip_safe=False)
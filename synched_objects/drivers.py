@@ -1,101 +1,415 @@
-import json
 import os
+import time
+import warnings
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from abc import ABC, abstractmethod
 import sqlite3
 from sqlite3 import Error as SQLError
 
-from .utils import assert_type
+from .utils import INDENT, assert_type, dumps, encode_rows, loads, orjson
 
-INDENT = 4
 SEP = '\n'
+HEADER = b'['
+FOOTER = f'{SEP}]'.encode()
+FIRST_ITEM = f"{SEP}{' '*INDENT}".encode()
+NEXT_ITEM = f",{SEP}{' '*INDENT}".encode()
+NEWLINE = SEP.encode()
+# Windows has neither sysconf nor positional or vectored writes, nor O_DSYNC
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+O_BINARY = getattr(os, 'O_BINARY', 0)
+O_DSYNC = getattr(os, 'O_DSYNC', 0)
+FLUSH_POLICIES = ('never', 'batch', 'periodic')
+# Enough to find the closing bracket of a file to append to
+TAIL_SIZE = 4096
+# Large enough for a whole batch to be written with a single syscall
+BUFFER_SIZE = 1 << 20
+
+
+if hasattr(os, 'pwrite'):
+    pread = os.pread
+    pwrite = os.pwrite
+else:
+    def pread(fd: int, size: int, offset: int) -> bytes:
+        """ os.pread emulated with seeks, the file position is left unchanged """
+        position = os.lseek(fd, 0, os.SEEK_CUR)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+        finally:
+            os.lseek(fd, position, os.SEEK_SET)
+    
+    def pwrite(fd: int, data: bytes, offset: int) -> int:
+        """ os.pwrite emulated with seeks, the file position is left unchanged """
+        position = os.lseek(fd, 0, os.SEEK_CUR)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+        finally:
+            os.lseek(fd, position, os.SEEK_SET)
+
+
+def pwritev(fd: int, buffers: List[bytes], offset: int) -> int:
+    """ Write all buffers at offset without joining them, returns the end offset """
+    
+    # A lone buffer does not need the vectored syscall
+    if len(buffers) == 1:
+        size = len(buffers[0])
+        if pwrite(fd, buffers[0], offset) != size:
+            raise OSError(f'Short write on file descriptor {fd}')
+        return offset + size
+    
+    for i in range(0, len(buffers), IOV_MAX):
+        chunk = buffers[i:i+IOV_MAX]
+        size = sum(map(len, chunk))
+        # Without the vectored syscall, the chunk is joined to keep a single write
+        written = os.pwritev(fd, chunk, offset) if hasattr(os, 'pwritev') else pwrite(fd, b''.join(chunk), offset)
+        if written != size:
+            raise OSError(f'Short write on file descriptor {fd}')
+        offset += size
+    return offset
+
+
+def encode_items(items: List[Dict], first: bool) -> Tuple[bytes, memoryview]:
+    """ Encode items as json array elements, following earlier elements unless first.
+    Returns the separator and the payload to write after it """
+    
+    # Without orjson, rows of scalars skip the pure python indented stdlib encoder
+    if orjson is None:
+        output = encode_rows(items)
+        if output is not None:
+            return FIRST_ITEM if first else NEXT_ITEM, output.encode()
+    
+    # One encoder call for the whole batch, its brackets are dropped without copying
+    output = dumps(items)
+    start = len(HEADER) + len(FIRST_ITEM)
+    return FIRST_ITEM if first else NEXT_ITEM, memoryview(output)[start:-len(FOOTER)]
 
 
 class Driver(ABC):
     """ Abstract class for Drivers """
     
+    __slots__ = ()
+    
     @abstractmethod
     def write(self, data: List[Dict]):
         """ Method to write depending on the specific implementation """
         pass
+    
+    def flush(self):
+        """ Make previously written data persistent, no-op by default """
+        pass
+    
+    def close(self):
+        """ Flush then release the driver resources """
+        self.flush()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
 
 class JsonDriver(Driver):
-    """ Json driver that supports appending to existing jsons """
+    """ Json driver that supports appending to existing jsons
     
-    def __init__(self, filename: str, overwrite: bool = False, append: bool = False) -> None:
+    durable: open the file with O_DSYNC so each write only returns once on disk
+    flush_policy: when written data is pushed to the OS and the file made valid json
+        - 'never': only at explicit sync points (flush or close), fastest but a crash
+          loses everything written since the last one
+        - 'periodic': once `fsync_every` writes were made or `fsync_interval` seconds
+          passed since the last sync, followed by an fsync, so a crash loses at most
+          that many writes or that long. Writes in between stay buffered
+        - 'batch': after every write, followed by an fsync, a crash loses nothing
+          but each write costs several syscalls
+    fsync_every: number of writes between two syncs of the periodic policy
+    fsync_interval: seconds after which the periodic policy syncs on the next write
+    """
+    
+    __slots__ = ('filename', 'overwrite', 'append', 'durable', 'flush_policy', 'fsync_every',
+                 'fsync_interval', 'isempty', 'file', 'offset', 'end', 'unsynced', 'lastfsync')
+    
+    def __init__(self, filename: str, overwrite: bool = False, append: bool = False,
+                 durable: bool = False, flush_policy: str = 'periodic', fsync_every: int = 100,
+                 fsync_interval: float = 1.0) -> None:
         super().__init__()
         
-        assert_type(filename, 'filename', (str, Path))
-        assert_type(overwrite, 'overwrite', bool)
-        assert_type(append, 'append', bool)
+        if __debug__:
+            assert_type(filename, 'filename', (str, Path))
+            assert_type(overwrite, 'overwrite', bool)
+            assert_type(append, 'append', bool)
+            assert_type(durable, 'durable', bool)
+            assert_type(flush_policy, 'flush_policy', str)
+            assert_type(fsync_every, 'fsync_every', int)
+            assert_type(fsync_interval, 'fsync_interval', (int, float))
+        assert flush_policy in FLUSH_POLICIES, f'flush_policy must be one of {FLUSH_POLICIES}'
+        assert fsync_every > 0
+        assert fsync_interval > 0
         
         self.filename = Path(filename)
         self.overwrite = overwrite
         self.append = append
+        self.durable = durable
+        self.flush_policy = flush_policy
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.unsynced = 0
+        self.lastfsync = time.monotonic()
         
         self.__post_init__()
+        
+        # New files are valid json from the start
+        if self.flush_policy != 'never':
+            self.flush()
             
     def __post_init__(self):
         """ Create or open file then trunctate or append """
         
-        # File exists and we are not overwriting nor appending
-        if Path(self.filename).is_file() and not (self.overwrite or self.append):
-            raise FileExistsError(f'File already exists {self.filename}')
-        
         self.isempty = True
+        self.end = 0
         
-        # Create new file if file does not exist or we overwriting
-        if not Path(self.filename).is_file() or self.overwrite:
-            open(self.filename, "w").close()
+        # Create new file if file does not exist or truncate it if we are overwriting
+        # when neither overwriting nor appending the open fails if the file exists
+        flags = os.O_RDWR | os.O_CREAT | O_BINARY
+        if self.overwrite:
+            flags |= os.O_TRUNC
+        elif not self.append:
+            flags |= os.O_EXCL
+        if self.durable:
+            # Each write only returns once the data reached the disk
+            if not O_DSYNC:
+                raise ValueError('durable is not supported, O_DSYNC is not available on this platform')
+            flags |= O_DSYNC
         
-        # Open the file in read write update binary mode
-        self.file = open(self.filename, mode='rb+')
-        assert self.file is not None, f'Could not create file {self.filename}'
+        # Open the file in read write update binary mode, unbuffered when durable
+        # so that each write is a single synchronous syscall
+        fd = os.open(self.filename, flags, 0o666)
+        self.file = os.fdopen(fd, mode='rb+', buffering=0 if self.durable else BUFFER_SIZE)
         
-        if self.append and not self.overwrite:
-            # Check if file is not empty
+        # The end of the written data is tracked here instead of seeking to it
+        # only a file we are appending to can be non empty at this point
+        size = os.fstat(fd).st_size if self.append and not self.overwrite else 0
+        if size != 0:
+            # Items are appended in place of the closing bracket and surrounding whitespace,
+            # the file is left untouched until the first write overwrites them
+            start = max(0, size - TAIL_SIZE)
+            tail = pread(fd, size - start, start).rstrip()
+            if not tail.endswith(b']'):
+                self.file.close()
+                raise ValueError(f'Cannot append to {self.filename}, it does not end with a json array')
+            tail = tail[:-1].rstrip()
             
-            self.file.seek(0, os.SEEK_END)  # Go to end of file
-            if self.file.tell() != 0:
-                # if current position is truish (i.e != 0) then file is not empty       
-                self.isempty = False
-            else:
-                # reset the cursor when file is empty
-                self.file.seek(0)
+            self.offset = self.file.seek(start + len(tail))
+            self.end = size
+            self.isempty = tail.endswith(HEADER)
         else:
-            self.file.truncate()
+            # Durable files always end with the closing bracket
+            self.file.write(HEADER + FOOTER if self.durable else HEADER)
+            self.offset = len(HEADER)
 
     def write(self, data: List[Dict]):
         
         assert isinstance(data, list)
         if len(data) == 0: return
+        
+        # Items are appended after the opening bracket without joining them
+        # the closing bracket is only written at sync points
+        output = encode_items(data, self.isempty)
+        self.isempty = False
+        if self.durable:
+            # Single synchronous syscall for the whole batch and the closing bracket after it
+            self.offset = pwritev(self.file.fileno(), [*output, FOOTER], self.offset) - len(FOOTER)
+            self.trim()
+        else:
+            for chunk in output:
+                self.offset += self.file.write(chunk)
+        
+        self.autosync()
+    
+    def autosync(self):
+        """ Sync after a write depending on the flush policy """
+        
+        if self.flush_policy == 'never':
+            return
+        
+        # Writes below the threshold cost no syscall, time is only checked on write
+        self.unsynced += 1
+        if (self.flush_policy == 'batch' or self.unsynced >= self.fsync_every
+                or time.monotonic() - self.lastfsync >= self.fsync_interval):
+            self.flush()
+            self.fsync()
+    
+    def flush(self):
+        """ Close the json array on disk past the offset so next writes overwrite it """
+        # Durable writes already end with the closing bracket
+        if not self.durable:
+            self.file.flush()
+            pwrite(self.file.fileno(), FOOTER, self.offset)
+        self.trim()
+    
+    def trim(self):
+        """ Drop what is left of the original end of a file appended to past the closing bracket """
+        if self.end > self.offset + len(FOOTER):
+            os.ftruncate(self.file.fileno(), self.offset + len(FOOTER))
+        # Once synced, the file never extends past the closing bracket again
+        self.end = 0
+    
+    def fsync(self):
+        """ Wait until synced data reached the disk, already the case when durable """
+        if not self.durable:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.lastfsync = time.monotonic()
+    
+    def close(self):
+        """ Write the closing bracket then close the file """
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+    
+    def __del__(self):
+        # Only warn for files that were successfully opened
+        if hasattr(self, 'offset') and not self.file.closed:
+            warnings.warn(f'{type(self).__name__} of {self.filename} was not closed', ResourceWarning)
+            self.close()
 
-        output = json.dumps(data, indent=INDENT)
+
+class BatchedJsonDriver(JsonDriver):
+    """ Json driver that queues encoded items in memory and drains them
+    with a single vectored write every `depth` writes, when more than
+    BUFFER_SIZE bytes are queued and at sync points """
+    
+    __slots__ = ('depth', 'pending', 'nwrites', 'nbytes')
+    
+    def __init__(self, filename: str, overwrite: bool = False, append: bool = False,
+                 durable: bool = False, flush_policy: str = 'periodic', fsync_every: int = 100,
+                 depth: int = 64, fsync_interval: float = 1.0) -> None:
         
-        # When file is empty we write the ouput directly
-        # Else we have to trim the brackets for proper appending
-        if not self.isempty:
-            # Roll back the cursor to overwrite the last `\n]`
-            END = -len(SEP)-len(']')
-            self.file.seek(END, os.SEEK_END)
-            
-            # Format string to be appended
-            START = len('[')+len(SEP)+INDENT
-            output = f",{SEP}{' '*INDENT}" + output[START:]
+        if __debug__:
+            assert_type(depth, 'depth', int)
+        assert depth > 0
+        
+        self.depth = depth
+        super().__init__(filename, overwrite=overwrite, append=append, durable=durable,
+                         flush_policy=flush_policy, fsync_every=fsync_every,
+                         fsync_interval=fsync_interval)
         
-        self.file.write(output.encode())
+    def __post_init__(self):
+        super().__post_init__()
+        
+        # Writes are positional from now on, the file cursor is never used again
         self.file.flush()
+        self.pending = []
+        self.nwrites = 0
+        self.nbytes = 0
+        
+    def write(self, data: List[Dict]):
+        
+        assert isinstance(data, list)
+        if len(data) == 0: return
+        
+        # Encoded buffers are kept alive in `pending` until drained
+        for chunk in encode_items(data, self.isempty):
+            self.pending.append(chunk)
+            self.nbytes += len(chunk)
         self.isempty = False
+        
+        self.nwrites += 1
+        if self.nwrites >= self.depth or self.nbytes >= BUFFER_SIZE:
+            self.drain()
+        
+        self.autosync()
+    
+    def drain(self):
+        """ Write all pending buffers at the current offset """
+        
+        # Sync points with nothing queued do not issue any syscall
+        if not self.pending:
+            return
+        
+        if self.durable:
+            # The closing bracket goes with the pending buffers in the same synchronous syscall
+            self.pending.append(FOOTER)
+            self.offset = pwritev(self.file.fileno(), self.pending, self.offset) - len(FOOTER)
+            self.trim()
+        else:
+            self.offset = pwritev(self.file.fileno(), self.pending, self.offset)
+        self.pending = []
+        self.nwrites = 0
+        self.nbytes = 0
+    
+    def flush(self):
+        """ Drain pending writes then close the json array """
+        self.drain()
+        super().flush()
+
+
+class NDJsonDriver(Driver):
+    """ Newline delimited json driver, one item per line.
+    The file is opened in append mode so a batch is a single write without any
+    seek or bracket handling, use `load_ndjson` to read it back """
+    
+    __slots__ = ('filename', 'overwrite', 'append', 'fd')
+    
+    def __init__(self, filename: str, overwrite: bool = False, append: bool = False) -> None:
+        super().__init__()
+        
+        if __debug__:
+            assert_type(filename, 'filename', (str, Path))
+            assert_type(overwrite, 'overwrite', bool)
+            assert_type(append, 'append', bool)
+        
+        self.filename = Path(filename)
+        self.overwrite = overwrite
+        self.append = append
+        
+        # Same rules as JsonDriver, an existing file is either truncated or appended to
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | O_BINARY
+        if self.overwrite:
+            flags |= os.O_TRUNC
+        elif not self.append:
+            flags |= os.O_EXCL
+        
+        self.fd = os.open(self.filename, flags, 0o666)
+        
+    def write(self, data: List[Dict]):
+        
+        assert isinstance(data, list)
+        if len(data) == 0: return
+        
+        # The trailing empty line ends the last item with a newline without another copy
+        lines = [dumps(item, indent=False) for item in data]
+        lines.append(b'')
+        output = NEWLINE.join(lines)
+        
+        # A single append write, concurrent writers do not interleave lines
+        if os.write(self.fd, output) != len(output):
+            raise OSError(f'Short write on file descriptor {self.fd}')
+    
+    def close(self):
+        """ Close the file, every write already reached the OS """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
     
     def __del__(self):
-        self.file.flush()
-        self.file.close()
+        if hasattr(self, 'fd') and self.fd >= 0:
+            warnings.warn(f'{type(self).__name__} of {self.filename} was not closed', ResourceWarning)
+            self.close()
+
+
+def load_ndjson(filename: str) -> List[Dict]:
+    """ Load the items written by a NDJsonDriver """
+    
+    with open(filename, mode='rb') as file:
+        return [loads(line) for line in file if line.strip()]
 
 
 class SQLDriver(Driver):
     
     __table__ = 'data'
+    __slots__ = ('cols', 'conn', 'cursor', 'type_mapping', 'types', 'ordered_keys',
+                 'parser', 'sql_create_table', 'sql_insert_item')
     
     def __init__(self, dbname: str) -> None:
         super().__init__()
@@ -104,21 +418,26 @@ class SQLDriver(Driver):
         
         try:
             
-            Path(dbname).unlink(missing_ok=True)
-            self.conn = sqlite3.connect(dbname)
+            # Write ahead log files of a previous database must go too
+            for suffix in ('', '-wal', '-shm'):
+                Path(f'{dbname}{suffix}').unlink(missing_ok=True)
+            # Writes may come from an AsyncDriverSynchedList writer thread
+            self.conn = sqlite3.connect(dbname, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('PRAGMA temp_store=MEMORY')
             self.cursor = self.conn.cursor()
         except SQLError as e:
             raise(e)       
         
-    def parser(self, item: Dict) -> List:
+    def check(self, item: Dict):
+        """ Create the table from the first item then validate keys of later items """
         
         if self.cols is None:
             self.init_db(item)
         else:
-            assert self.cols == set(item), f'item must have the same keys as previously \
+            assert item.keys() == self.cols, f'item must have the same keys as previously \
                 inserted items. Expected {self.cols} got {set(item)}'
-                
-        return [type_func(item[key]) for key, type_func in self.types.items()]
     
     def init_db(self, item):
         
@@ -144,6 +463,17 @@ class SQLDriver(Driver):
             self.types[k] = type_func
             object_names.append(f'{k} {self.type_mapping[type_func]}')
         
+        # Row parser specialized for this schema, keys and converters are baked in
+        # e.g. def parser(item): return (int(item['a']), float(item['b']),)
+        # missing keys raise a KeyError, extra keys are caught by the length check
+        namespace = {f'type_func{i}': self.types[k] for i, k in enumerate(self.ordered_keys)}
+        namespace.update(N=len(self.ordered_keys), check=self.check)
+        fields = ''.join(f'type_func{i}(item[{k!r}]), ' for i, k in enumerate(self.ordered_keys))
+        exec('def parser(item):\n'
+             '    if len(item) != N: check(item)\n'
+             f'    return ({fields})\n', namespace)
+        self.parser = namespace['parser']
+        
         self.sql_create_table = f"""CREATE TABLE {self.__table__} 
             (id integer PRIMARY KEY, {', '.join(object_names)} );"""
             
@@ -159,12 +489,27 @@ class SQLDriver(Driver):
     
     def write(self, data: List[Dict]):
         
-        parsed_data = [self.parser(item) for item in data]
-        self.cursor.executemany(self.sql_insert_item, parsed_data)
+        if len(data) == 0: return
         
-    def __del__(self):
-        if hasattr(self, 'conn'):
+        # Only the first item of a batch is validated, this also creates
+        # the table which must exist before rows are streamed to executemany
+        self.check(data[0])
+        
+        # One transaction committed per batch
+        rows = map(self.parser, data)
+        with self.conn:
+            self.cursor.executemany(self.sql_insert_item, rows)
+        
+    def close(self):
+        """ Close the database connection, every batch is already committed """
+        if self.conn is not None:
             self.conn.close()
+            self.conn = None
+    
+    def __del__(self):
+        if getattr(self, 'conn', None) is not None:
+            warnings.warn(f'{type(self).__name__} was not closed', ResourceWarning)
+            self.close()
     
     def get_data(self) -> List[Dict]:
         self.cursor.execute(f'SELECT * FROM {self.__table__}')
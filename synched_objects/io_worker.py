@@ -0,0 +1,163 @@
+import atexit
+from queue import Empty, SimpleQueue
+from threading import Condition, Event, Lock, Thread, current_thread
+from typing import List, Optional
+
+from .drivers import Driver
+
+# Maximum number of requests handled per wake up of the worker thread
+DRAIN_SIZE = 32
+# Default maximum number of queued batches before producers wait for the worker
+MAX_QUEUED = 256
+
+# Request closing a driver once its queued batches are written
+CLOSE = 'close'
+
+
+class IOWorker:
+    """ Background thread writing batches for any number of drivers.
+
+    Requests are (driver, errors, request) tuples, request being either a batch of
+    items to write, an Event set once the driver is synced or CLOSE. Exceptions raised
+    by a driver are appended to the errors list queued with it.
+    Requests are handled in order, so a driver synced after its batches were queued
+    is up to date once the Event is set. The thread is started on the first request
+    and stopped at interpreter exit once every queued request is handled
+
+    maxsize: number of queued batches beyond which submit waits for the worker
+    """
+
+    __slots__ = ('requests', 'lock', 'thread', 'maxsize', 'queued', 'space')
+
+    def __init__(self, maxsize: int = MAX_QUEUED) -> None:
+        assert isinstance(maxsize, int)
+        assert maxsize > 0
+
+        self.requests = SimpleQueue()
+        self.lock = Lock()
+        self.thread = None
+        self.maxsize = maxsize
+        self.queued = 0
+        self.space = Condition(Lock())
+
+    def put(self, request) -> None:
+        """ Queue a request, starting the worker thread unless it is running """
+
+        # The worker queues requests while handling others, e.g. when it collects a list
+        # it is running and may hold up stop, which waits for it under the lock
+        if current_thread() is self.thread:
+            self.requests.put(request)
+            return
+
+        # Under the lock a request is never queued behind the sentinel of a stopping thread
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+                # Daemon threads are killed at exit, queued batches are written before
+                atexit.register(self.stop)
+            self.requests.put(request)
+
+    def stop(self) -> None:
+        """ Handle every queued request then stop the worker thread,
+        it is started again by the next request """
+
+        with self.lock:
+            if self.thread is None:
+                return
+            atexit.unregister(self.stop)
+            self.requests.put(None)
+            # From the worker thread itself, the sentinel is handled after the current requests
+            if self.thread is not current_thread():
+                self.thread.join()
+            self.thread = None
+
+    def submit(self, driver: Driver, errors: List[Exception], batch: List) -> None:
+        """ Queue a batch to write, the worker takes ownership of the batch.
+        Waits while `maxsize` batches are queued so producers cannot outrun the disk """
+
+        with self.space:
+            # The worker never waits for itself
+            if current_thread() is not self.thread:
+                while self.queued >= self.maxsize:
+                    self.space.wait()
+            self.queued += 1
+        self.put((driver, errors, batch))
+
+    def sync(self, driver: Optional[Driver], errors: Optional[List[Exception]]) -> Event:
+        """ Queue a sync of driver, the returned Event is set once it is done """
+
+        synced = Event()
+        self.put((driver, errors, synced))
+        return synced
+
+    def close(self, driver: Driver, errors: List[Exception]) -> None:
+        """ Queue closing driver without waiting for it """
+
+        self.put((driver, errors, CLOSE))
+
+    def wait_idle(self) -> None:
+        """ Wait until every request queued before the call is handled """
+
+        self.sync(None, None).wait()
+
+    def run(self) -> None:
+        """ Worker thread loop, drains up to DRAIN_SIZE requests per wake up
+        until the None sentinel queued by stop """
+
+        while True:
+            pending = [self.requests.get()]
+            try:
+                while len(pending) < DRAIN_SIZE and pending[-1] is not None:
+                    pending.append(self.requests.get_nowait())
+            except Empty:
+                pass
+
+            if pending[-1] is None:
+                self.process(pending[:-1])
+                # Only this thread can queue requests while stop holds the lock
+                try:
+                    while True:
+                        self.process([self.requests.get_nowait()])
+                except Empty:
+                    return
+            self.process(pending)
+
+    def process(self, pending: List[tuple]) -> None:
+        """ Handle drained requests in order """
+
+        i = 0
+        batches = 0
+        while i < len(pending):
+            driver, errors, request = pending[i]
+            i += 1
+            try:
+                if isinstance(request, Event):
+                    if driver is not None:
+                        driver.flush()
+                elif request is CLOSE:
+                    driver.close()
+                else:
+                    # Consecutive batches of one driver are written with a single call
+                    batches += 1
+                    while (i < len(pending) and pending[i][0] is driver
+                           and isinstance(pending[i][2], list)):
+                        request.extend(pending[i][2])
+                        batches += 1
+                        i += 1
+                    driver.write(request)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if isinstance(request, Event):
+                    request.set()
+
+        # Written batches make room for waiting producers
+        if batches:
+            with self.space:
+                self.queued -= batches
+                self.space.notify_all()
+
+
+# Worker shared by the AsyncDriverSynchedList instances by default
+WORKER = IOWorker()
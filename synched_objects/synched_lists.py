@@ -1,17 +1,22 @@
-import json
+import sys
+import warnings
 from pathlib import Path
-from typing import Any, Iterable
+from threading import current_thread
+from typing import Any, Iterable, Optional
 from abc import ABC, abstractmethod
-from .drivers import Driver
+from .drivers import BUFFER_SIZE, FOOTER, HEADER, Driver, encode_items, pwrite
+from .io_worker import WORKER, IOWorker
 
-INDENT = 4
 SEP = '\n'
 
 class SynchedList(ABC):
     """
-    Abstract class of synched lists defining the workflow
+    Abstract class of synched lists defining the workflow.
+    Only items not yet synchronized are kept in `data`, `written` counts the others
     """
     
+    __slots__ = ('frequency', 'lastflush', 'data', 'written')
+    
     def __init__(self, frequency : int = 5) -> None:
         super().__init__()
         
@@ -21,9 +26,10 @@ class SynchedList(ABC):
         self.frequency = frequency
         self.lastflush = 0
         self.data = list()
+        self.written = 0
         
     def __len__(self):
-        return len(self.data)
+        return self.written + len(self.data)
         
     def append(self, item: Any) -> None:
         self.data.append(item)
@@ -31,10 +37,10 @@ class SynchedList(ABC):
         self.autoflush()
         
     def extend(self, iterable: Iterable[Any]) -> None:
-        # better than using len(iterable) in case iterable is a generator
-        n = len(self.data)
-        self.data.extend(iterable)
-        self.lastflush += (len(self.data) - n)
+        # Generators are materialized once, their length is then counted directly
+        staging = iterable if type(iterable) is list else list(iterable)
+        self.lastflush += len(staging)
+        self.data.extend(staging)
         self.autoflush()
         
     def autoflush(self) -> None:
@@ -51,8 +57,19 @@ class SynchedList(ABC):
         """
         pass
     
+    def close(self) -> None:
+        """Synchronize the remaining items and release the underlying resources"""
+        self.flush()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc) -> None:
+        self.close()
+    
     def __repr__(self) -> str:
-        return str(self.data)   
+        # Written items are no longer in memory, only counts are shown
+        return f'{type(self).__name__}(written={self.written}, pending={len(self.data)})'
     
     
 class JsonSynchedList(SynchedList):
@@ -67,6 +84,8 @@ class JsonSynchedList(SynchedList):
     
     """
     
+    __slots__ = ('filename', 'overwrite', 'file', 'offset')
+    
     def __init__(self, filename: str, frequency: int = 100, overwrite: bool = True) -> None:
         super().__init__(frequency=frequency)
         
@@ -76,24 +95,35 @@ class JsonSynchedList(SynchedList):
         self.filename = Path(filename)
         self.overwrite = overwrite
         
-        if not self.overwrite and self.filename.is_file():
-            raise FileExistsError('Cannot overwrite file')
-        
-        self.file = open(self.filename, "wb")
+        # Exclusive creation raises FileExistsError when not overwriting
+        self.file = open(self.filename, "wb" if self.overwrite else "xb", buffering=BUFFER_SIZE)
+        self.offset = self.file.write(HEADER)
 
     def flush(self) -> None:
-        """Flush data to disk"""
-        self.file.seek(0)
-        output = json.dumps(self.data, indent=4).encode()
-        self.file.write(output)
+        """Append items added since the last flush to disk"""
+        # New items are encoded at once then dropped from memory
+        if self.data:
+            for chunk in encode_items(self.data, self.written == 0):
+                self.offset += self.file.write(chunk)
+            self.written += len(self.data)
+            self.data.clear()
+        
+        # Close the json array past the offset so the next flush overwrites it
         self.file.flush()
+        pwrite(self.file.fileno(), FOOTER, self.offset)
         self.lastflush = 0
 
-    def __del__(self) -> None:
-        """Auto flush to disk when object is removed"""
-        if hasattr(self, 'file'):
+    def close(self) -> None:
+        """Flush to disk and close the file"""
+        if not self.file.closed:
             self.flush()
             self.file.close()
+
+    def __del__(self) -> None:
+        """Warn and close when the list is removed without being closed"""
+        if hasattr(self, 'offset') and not self.file.closed:
+            warnings.warn(f'{type(self).__name__} was not closed', ResourceWarning)
+            self.close()
             
 
 class DriverSynchedList(SynchedList):
@@ -103,23 +133,113 @@ class DriverSynchedList(SynchedList):
     frequency: frequency of the disk flush
     """
     
+    __slots__ = ('driver',)
+    
     def __init__(self, driver: Driver, frequency: int = 100) -> None:
         super().__init__(frequency=frequency)
         
         assert issubclass(type(driver), Driver)
         self.driver = driver
             
-    def flush(self) -> None:
-        """Flush data to disk"""
+    def autoflush(self) -> None:
+        """Hand pending items to the driver without forcing a sync"""
+        if self.lastflush >= self.frequency:
+            self.write()
+            
+    def write(self) -> None:
+        """Write pending items using the driver"""
         
+        # The pending list is handed over to the driver, memory is bounded by frequency
         if self.lastflush != 0:
-            self.driver.write(self.data[-self.lastflush:])
-            self.lastflush = 0          
+            self.driver.write(self.data)
+            self.written += len(self.data)
+            self.data = list()
+            self.lastflush = 0
             
-    def __del__(self) -> None:
-        """Auto flush when object is removed"""
+    def flush(self) -> None:
+        """Write pending items and sync the driver"""
+        
+        self.write()
+        self.driver.flush()
+            
+    def close(self) -> None:
+        """Flush pending items and close the driver, the list owns its driver"""
         
         if hasattr(self, 'driver'):
             self.flush()
-            del self.driver      
+            self.driver.close()
+            del self.driver
+            
+    def __del__(self) -> None:
+        """Warn and close when the list is removed without being closed"""
+        
+        if hasattr(self, 'driver'):
+            warnings.warn(f'{type(self).__name__} was not closed', ResourceWarning)
+            self.close()
+
 
+class AsyncDriverSynchedList(DriverSynchedList):
+    """ This a list wrapper that saves list content using a driver in a background thread.
+    Appending only queues batches, encoding and I/O happen off the caller thread
+    
+    driver: driver to use to save data, only used by the worker thread afterwards
+    frequency: frequency of the disk flush
+    worker: IOWorker writing the batches, by default one thread is shared by all lists
+    """
+    
+    __slots__ = ('worker', 'errors')
+    
+    def __init__(self, driver: Driver, frequency: int = 100, worker: Optional[IOWorker] = None) -> None:
+        super().__init__(driver, frequency=frequency)
+        
+        assert worker is None or isinstance(worker, IOWorker)
+        
+        # The worker only holds the driver and errors, not self, so __del__ is still called
+        self.worker = WORKER if worker is None else worker
+        self.errors = []
+        
+    def write(self) -> None:
+        """Queue pending items for the writer thread"""
+        
+        # The pending list is handed over to the worker thread as is
+        if self.lastflush != 0:
+            self.worker.submit(self.driver, self.errors, self.data)
+            self.written += len(self.data)
+            self.data = list()
+            self.lastflush = 0
+            
+    def flush(self) -> None:
+        """Queue pending items and wait until they are written and synced"""
+        
+        self.write()
+        self.worker.sync(self.driver, self.errors).wait()
+        
+        if self.errors:
+            raise self.errors.pop(0)
+            
+    def close(self) -> None:
+        """Wait until the worker synced all pending items and close the driver.
+        Never blocks when called from the worker thread or at interpreter exit"""
+        
+        if not hasattr(self, 'driver'):
+            return
+        
+        if sys.is_finalizing():
+            # The worker was stopped at exit once queued batches were written
+            DriverSynchedList.write(self)
+            self.driver.close()
+            del self.driver
+        elif current_thread() is self.worker.thread:
+            # Collected by the worker itself, waiting on it would deadlock
+            # its errors can no longer be reported
+            self.write()
+            self.worker.close(self.driver, self.errors)
+            del self.driver
+        else:
+            self.write()
+            self.worker.sync(self.driver, self.errors).wait()
+            self.driver.close()
+            del self.driver
+            
+            if self.errors:
+                raise self.errors.pop(0)
@@ -1,15 +1,136 @@
-from typing import Any, Tuple, Type, Union
+import json
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, List, Optional, Tuple, Type, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson only supports a fixed 2 spaces indentation
+INDENT = 2
+
+# Compact items go through the C accelerated stdlib encoder, including its
+# ascii string escaping, and match orjson compact separators
+COMPACT_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+INFINITY = float('inf')
+
+# Wider rows are left to the json module, their generated expression would be too deep to compile
+MAX_ROW_KEYS = 128
+# Number of row schemas whose generated encoders are kept
+ROW_ENCODERS_SIZE = 64
+
+
+def encode_float(value: float) -> str:
+    """ Encode a float like the stdlib json encoder """
+    
+    if value != value:
+        return 'NaN'
+    if value == INFINITY:
+        return 'Infinity'
+    if value == -INFINITY:
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+# Exact types only, subclasses such as bool or enums are left to the json module
+SCALAR_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: encode_float,
+    bool: {True: 'true', False: 'false'}.__getitem__,
+    type(None): lambda value: 'null',
+}
+
 
 def assert_type(object: Any, name: str, types: Union[Tuple[Type], Type]):
+    """ Raise a TypeError if object is not an instance of types.
+    Like assert, callers skip it under `python -O` by guarding it with `if __debug__` """
     
-    if not isinstance(types, (tuple, list)):
+    # Success path is a single isinstance, the message is only built on failure
+    if isinstance(object, types):
+        return
+    
+    if not isinstance(types, tuple):
         types = (types,)
-    elif isinstance(types, list):
-        types = tuple(types)
     
-    typename = lambda x: x.__name__
+    raise TypeError(f"{name} must be of type {[t.__name__ for t in types]} "
+                    f"got type {type(object).__name__}")
+
+
+def dumps(object: Any, indent: bool = True) -> bytes:
+    """ Serialize object to utf-8 json, using orjson when available.
+    orjson writes NaN and Infinity as null where the stdlib writes the non standard
+    NaN and Infinity literals. Objects orjson rejects, such as integers wider than
+    64 bits, are serialized by the stdlib """
+    
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(object, option=option)
+        except orjson.JSONEncodeError:
+            pass
+    if indent:
+        return json.dumps(object, indent=INDENT).encode()
+    return COMPACT_ENCODER.encode(object).encode()
+
+
+@lru_cache(maxsize=ROW_ENCODERS_SIZE)
+def compile_row_encoder(keys: Tuple[str, ...]) -> Optional[Callable[[List[dict]], str]]:
+    """ Generate a function encoding rows with these keys of scalar values
+    as indented json objects, joined like the elements of an indented array.
+    Returns None for keys left to the json module, results are cached per keys """
+    
+    if len(keys) > MAX_ROW_KEYS or not all(type(key) is str for key in keys):
+        return None
+    
+    # Keys and their indented prefixes are baked in, only values are dispatched on their type
+    namespace = {'E': SCALAR_ENCODERS, 'N': len(keys)}
+    fields = []
+    for i, key in enumerate(keys):
+        namespace[f'K{i}'] = key
+        namespace[f'P{i}'] = ('{' if i == 0 else ',') + '\n' + ' ' * 2 * INDENT + encode_basestring_ascii(key) + ': '
+        fields.append(f'P{i} + E[type(r[K{i}])](r[K{i}])')
+    namespace['CLOSE'] = '\n' + ' ' * INDENT + '}'
+    namespace['SEP'] = ',\n' + ' ' * INDENT
+    
+    source = ('def encode(rows):\n'
+              '    for r in rows:\n'
+              '        if len(r) != N: raise KeyError\n'
+              f'    return SEP.join([{" + ".join(fields)} + CLOSE for r in rows])\n')
+    exec(source, namespace)
+    return namespace['encode']
+
+
+def encode_rows(rows: List[dict]) -> Optional[str]:
+    """ Encode rows sharing the keys of the first one like json.dumps(rows, indent=INDENT)
+    without the array brackets. Returns None when rows do not fit a generated encoder """
+    
+    if not rows or type(rows[0]) is not dict or not rows[0]:
+        return None
+    
+    encoder = compile_row_encoder(tuple(rows[0]))
+    if encoder is None:
+        return None
+    
+    # Rows with other keys or non scalar values fall back to the json module
+    try:
+        return encoder(rows)
+    except (KeyError, TypeError):
+        return None
+
+
+def loads(data: bytes) -> Any:
+    """ Deserialize utf-8 json, using orjson when available """
     
-    if not isinstance(object, types):
-        raise TypeError(f"{name} must be of type \
-                        {list(map(typename, types))} \
-                        got type {typename(type(object))}")
+    # The stdlib also parses what it wrote when orjson rejected an object, e.g. NaN
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
@@ -1,8 +1,13 @@
 import json
+import math
 import os
+import sqlite3
+
+import pytest
 
 from . import TESTING_FOLDER
-from synched_objects.drivers import JsonDriver, SQLDriver
+from synched_objects.drivers import BatchedJsonDriver, JsonDriver, NDJsonDriver, SQLDriver, load_ndjson
+from synched_objects.utils import encode_rows, orjson
 
 def test_json_driver():
 
@@ -17,20 +22,20 @@ def test_json_driver():
         t = [{'index': i, 'data': i**2} for i in range(j*5,(j+1)*5)]
         data.extend(t)
         drv.write(t)    
-    del drv
+    drv.close()
     
     drv = JsonDriver(filename=file, overwrite=False, append=True)
     a = [{'index': i, 'data': i**2} for i in range(-3,0)]
     data.extend(a)
     drv.write(a)
-    del drv
+    drv.close()
     
     
     drv = JsonDriver(filename=file, overwrite=False, append=True)
     b = [{'index': i**3, 'data': i/5} for i in range(-50,-40)]
     data.extend(b)
     drv.write(b)
-    del drv
+    drv.close()
     
     
     loaded_data = json.load(open(file, mode='r'))
@@ -38,6 +43,205 @@ def test_json_driver():
     assert len(data) == len(loaded_data)
     assert data == loaded_data
 
+def test_encode_rows():
+    
+    rows = [{'index': i, 'data': i/3, 'name': f'é"{i}', 'flag': i%2==0, 'none': None} for i in range(5)]
+    rows.append({'index': -1, 'data': float('inf'), 'name': '', 'flag': False, 'none': None})
+    assert encode_rows(rows) == json.dumps(rows, indent=2)[len('[\n  '):-len('\n]')]
+    
+    # Rows that do not fit the schema of the first one are left to the json module
+    assert encode_rows([{'index': 0}, {'index': 1, 'data': 1}]) is None
+    assert encode_rows([{'index': 0}, {'data': 1}]) is None
+    assert encode_rows([{'index': [0]}]) is None
+    assert encode_rows([{0: 'index'}]) is None
+    assert encode_rows([]) is None
+    
+    # Wide rows are left to the json module instead of failing to compile
+    assert encode_rows([{f'k{i}': i for i in range(2000)}]) is None
+
+def test_json_driver_special_values():
+    
+    file = TESTING_FOLDER / 'test_json_driver_special_values.json'
+    
+    # Integers wider than 64 bits are left to the stdlib encoder
+    with JsonDriver(filename=file, overwrite=True) as drv:
+        drv.write([{'index': 0, 'data': 2**70}])
+        drv.write([{'index': 1, 'data': float('nan')}, {'index': 2, 'data': float('inf')}])
+    
+    loaded = json.load(open(file, mode='r'))
+    assert loaded[0] == {'index': 0, 'data': 2**70}
+    if orjson is not None:
+        # orjson writes non finite floats as null
+        assert [item['data'] for item in loaded[1:]] == [None, None]
+    else:
+        assert math.isnan(loaded[1]['data']) and loaded[2]['data'] == float('inf')
+    
+    file = TESTING_FOLDER / 'test_ndjson_driver_special_values.ndjson'
+    with NDJsonDriver(filename=file, overwrite=True) as drv:
+        drv.write([{'index': 0, 'data': 2**70}, {'index': 1, 'data': [2**70, float('nan')]}])
+    
+    loaded = load_ndjson(file)
+    assert loaded[0] == {'index': 0, 'data': 2**70}
+    assert loaded[1]['data'][0] == 2**70 and math.isnan(loaded[1]['data'][1])
+
+def test_json_driver_empty():
+    
+    file = TESTING_FOLDER / 'test_json_driver_empty.json'
+    
+    drv = JsonDriver(filename=file, overwrite=True)
+    drv.write([])
+    drv.close()
+    
+    assert json.load(open(file, mode='r')) == []
+    
+    drv = JsonDriver(filename=file, append=True)
+    drv.write([{'index': 0}])
+    drv.close()
+    
+    assert json.load(open(file, mode='r')) == [{'index': 0}]
+    
+    with pytest.raises(FileExistsError):
+        JsonDriver(filename=file)
+
+def test_json_driver_append_foreign():
+    
+    file = TESTING_FOLDER / 'test_json_driver_append_foreign.json'
+    
+    data = [{'index': 0, 'data': [1, 2]}]
+    with open(file, mode='w') as fp:
+        json.dump(data, fp)
+        fp.write('\n')
+    
+    drv = JsonDriver(filename=file, append=True)
+    a = [{'index': 1, 'data': []}]
+    drv.write(a)
+    drv.close()
+    
+    assert json.load(open(file, mode='r')) == data + a
+    
+    # Opening leaves the file valid until data is actually written
+    drv = BatchedJsonDriver(filename=file, append=True)
+    drv.write(a)
+    assert json.load(open(file, mode='r')) == data + a
+    drv.close()
+    assert json.load(open(file, mode='r')) == data + a + a
+    
+    # A closing bracket longer than ours does not leave stale bytes behind
+    with open(file, mode='w') as fp:
+        fp.write('[1   \n\n  ]  \n')
+    
+    JsonDriver(filename=file, append=True, flush_policy='never').close()
+    assert open(file, mode='r').read() == '[1\n]'
+    
+    with open(file, mode='w') as fp:
+        fp.write('{}')
+    
+    with pytest.raises(ValueError):
+        JsonDriver(filename=file, append=True)
+
+@pytest.mark.skipif(not hasattr(os, 'O_DSYNC'), reason='O_DSYNC is not available on this platform')
+def test_json_driver_durable():
+    
+    file = TESTING_FOLDER / 'test_json_driver_durable.json'
+    
+    # Each durable write also closes the json array, without any sync point
+    drv = JsonDriver(filename=file, overwrite=True, durable=True, flush_policy='never')
+    assert json.load(open(file, mode='r')) == []
+    data = [{'index': i, 'data': i**2} for i in range(5)]
+    drv.write(data[:2])
+    assert json.load(open(file, mode='r')) == data[:2]
+    drv.write(data[2:])
+    assert json.load(open(file, mode='r')) == data
+    drv.close()
+    
+    assert json.load(open(file, mode='r')) == data
+    
+    for driver in (JsonDriver, BatchedJsonDriver):
+        drv = driver(filename=file, append=True, durable=True)
+        a = [{'index': -1, 'data': driver.__name__}]
+        data.extend(a)
+        drv.write(a)
+        drv.flush()
+        assert json.load(open(file, mode='r')) == data
+        drv.close()
+
+def test_json_driver_flush_policy():
+    
+    file = TESTING_FOLDER / 'test_json_driver_flush_policy.json'
+    
+    for policy, every in [('batch', 1), ('periodic', 2)]:
+        drv = JsonDriver(filename=file, overwrite=True, flush_policy=policy, fsync_every=every,
+                         fsync_interval=3600)
+        
+        data = []
+        for j in range(4):
+            t = [{'index': j, 'data': j**2}]
+            data.extend(t)
+            drv.write(t)
+            
+            # File is valid json holding every item up to the last sync
+            synced = (j + 1) // every * every
+            assert json.load(open(file, mode='r')) == data[:synced]
+            assert drv.unsynced == (j + 1) % every
+        drv.close()
+    
+    # Elapsed time also triggers the periodic fsync
+    drv = JsonDriver(filename=file, overwrite=True, fsync_every=100, fsync_interval=1e-9)
+    drv.write([{'index': 0}])
+    assert drv.unsynced == 0
+    drv.close()
+    
+    # Nothing reaches the file before an explicit sync point
+    drv = JsonDriver(filename=file, overwrite=True, flush_policy='never')
+    drv.write([{'index': 0}])
+    assert os.path.getsize(file) == 0
+    drv.close()
+    assert json.load(open(file, mode='r')) == [{'index': 0}]
+
+def test_batched_json_driver():
+    
+    file = TESTING_FOLDER / 'test_batched_json_driver.json'
+    
+    drv = BatchedJsonDriver(filename=file, overwrite=True, depth=3)
+    
+    data = []
+    for j in range(10):
+        t = [{'index': i, 'data': i**2} for i in range(j*5,(j+1)*5)]
+        data.extend(t)
+        drv.write(t)
+        
+        if j == 4:
+            drv.flush()
+            assert json.load(open(file, mode='r')) == data
+    drv.close()
+    
+    drv = BatchedJsonDriver(filename=file, append=True)
+    a = [{'index': i, 'data': i/5} for i in range(-3,0)]
+    data.extend(a)
+    drv.write(a)
+    drv.close()
+    
+    assert json.load(open(file, mode='r')) == data
+
+def test_ndjson_driver():
+    
+    file = TESTING_FOLDER / 'test_ndjson_driver.ndjson'
+    
+    drv = NDJsonDriver(filename=file, overwrite=True)
+    data = [{'index': i, 'data': i**2} for i in range(10)]
+    drv.write(data[:4])
+    drv.write(data[4:])
+    
+    assert load_ndjson(file) == data
+    drv.close()
+    
+    drv = NDJsonDriver(filename=file, append=True)
+    a = [{'index': -1, 'data': 'appended'}]
+    drv.write(a)
+    drv.close()
+    
+    assert load_ndjson(file) == data + a
+
 def test_rb_ab():
     
     file = TESTING_FOLDER / 'test_ab_rb.json'
@@ -76,4 +280,37 @@ def test_sql_driver():
     fetched_data = driver.get_data()
     
     assert len(fetched_data) == len(data)
-    assert fetched_data == data
\ No newline at end of file
+    assert fetched_data == data
+    
+    # Later items with other keys fail instead of being stored partially
+    if __debug__:
+        with pytest.raises(AssertionError):
+            driver.write([data[0], {**data[0], 'extra': 'lost'}])
+        assert driver.get_data() == data
+    
+    # Batch is committed and visible to other connections
+    with sqlite3.connect(file) as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute(f'SELECT COUNT(*) FROM {SQLDriver.__table__}').fetchone()[0] == len(data)
+    driver.close()
+
+def test_driver_close():
+    
+    file = TESTING_FOLDER / 'test_driver_close.json'
+    
+    with JsonDriver(filename=file, overwrite=True) as drv:
+        drv.write([{'index': 0}])
+    
+    assert json.load(open(file, mode='r')) == [{'index': 0}]
+    
+    # Closing twice is harmless
+    drv.close()
+    
+    drv = JsonDriver(filename=file, append=True)
+    drv.write([{'index': 1}])
+    
+    # Dropping an unclosed driver warns but still syncs the file
+    with pytest.warns(ResourceWarning):
+        del drv
+    
+    assert json.load(open(file, mode='r')) == [{'index': 0}, {'index': 1}]
@@ -1,7 +1,12 @@
 import json
+import os
+import subprocess
+import sys
+from threading import Event, Thread
 
-from synched_objects.drivers import JsonDriver
-from synched_objects.synched_lists import SynchedList, JsonSynchedList, DriverSynchedList
+from synched_objects.drivers import Driver, JsonDriver, SQLDriver
+from synched_objects.io_worker import IOWorker
+from synched_objects.synched_lists import SynchedList, JsonSynchedList, DriverSynchedList, AsyncDriverSynchedList
 
 from . import TESTING_FOLDER
 
@@ -47,6 +52,11 @@ def test_jsonsynchedlist():
     assert len(l) == len(data)
     assert len(data) == len(loaded_data)
     assert data == loaded_data
+    assert len(l.data) == 0
+    
+    l.append({'index': -1, 'data': 1})
+    assert repr(l) == f'JsonSynchedList(written={len(data)}, pending=1)'
+    l.close()
    
 def test_driversynchedlist_jsondriver(total=20, frequency=5):
     
@@ -66,4 +76,219 @@ def test_driversynchedlist_jsondriver(total=20, frequency=5):
 
     assert len(l) == len(data)
     assert len(data) == len(loaded_data)
-    assert data == loaded_data
\ No newline at end of file
+    assert data == loaded_data
+    
+    # Written items are not kept in memory
+    assert len(l.data) == 0
+    l.close()
+
+class MemoryDriver(Driver):
+    """ Driver keeping the batches it is given """
+    
+    def __init__(self):
+        self.batches = []
+    
+    def write(self, data):
+        self.batches.append(data)
+
+def test_driversynchedlist_batches(frequency=3):
+    
+    """
+    Testing the driver keeps the batches it was handed
+    """
+    
+    driver = MemoryDriver()
+    l = DriverSynchedList(driver, frequency=frequency)
+    
+    data = list(range(7))
+    l.extend(data)
+    l.close()
+    
+    assert driver.batches == [data]
+    
+    driver = MemoryDriver()
+    l = DriverSynchedList(driver, frequency=frequency)
+    for item in data:
+        l.append(item)
+    l.close()
+    
+    assert driver.batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+def test_driversynchedlist_checkpoint(frequency=10, every=2):
+    
+    """
+    Testing the file stays valid json with the default flush policy
+    """
+    
+    file = TESTING_FOLDER / 'checkpoint_driver_synched_list.json'
+    driver = JsonDriver(file, overwrite=True, fsync_every=every, fsync_interval=3600)
+    l = DriverSynchedList(driver, frequency=frequency)
+    
+    data = [{'index': i, 'data': i**2} for i in range(45)]
+    for i, item in enumerate(data):
+        l.append(item)
+        
+        # Without any explicit flush, a crash keeps every item up to the last periodic sync
+        with open(file, 'rb') as f:
+            assert json.load(f) == data[:(i + 1) // (frequency * every) * (frequency * every)]
+    l.close()
+
+def test_asyncdriversynchedlist_jsondriver(total=20, frequency=5):
+    
+    """
+    Testing append and extend of the background synched list using the json driver
+    """
+    
+    file = TESTING_FOLDER / 'async_driver_synched_list.json'
+    driver = JsonDriver(file, overwrite=True)
+    l = AsyncDriverSynchedList(driver, frequency=frequency)
+    
+    data = fill_with_data(l, total=total)
+    l.flush()
+    
+    with open(file, 'rb') as f:
+        loaded_data = json.load(f)
+    
+    assert len(l) == len(data)
+    assert data == loaded_data
+    
+    more = [{'index': -1, 'data': 1}]
+    l.extend(more)
+    l.close()
+    
+    with open(file, 'rb') as f:
+        loaded_data = json.load(f)
+    
+    assert data + more == loaded_data
+
+def test_asyncdriversynchedlist_shared_worker(total=20, frequency=3):
+    
+    """
+    Testing several background synched lists written by one worker thread
+    """
+    
+    worker = IOWorker()
+    files = [TESTING_FOLDER / f'shared_worker_synched_list_{i}.json' for i in range(3)]
+    lists = [AsyncDriverSynchedList(JsonDriver(file, overwrite=True), frequency=frequency, worker=worker)
+             for file in files]
+    
+    data = [{'index': i, 'data': i**2} for i in range(total)]
+    for item in data:
+        for l in lists:
+            l.append(item)
+    
+    # Full batches are written without syncing, the pending ones stay in memory
+    worker.wait_idle()
+    for l in lists:
+        assert len(l.data) == total % frequency
+        l.close()
+    
+    for file in files:
+        with open(file, 'rb') as f:
+            assert json.load(f) == data
+    
+    # The worker thread is started again by the next request
+    worker.stop()
+    assert worker.thread is None
+    worker.wait_idle()
+    worker.stop()
+
+class GatedDriver(MemoryDriver):
+    """ Driver whose writes wait until the gate is open """
+    
+    def __init__(self):
+        super().__init__()
+        self.gate = Event()
+    
+    def write(self, data):
+        self.gate.wait()
+        super().write(data)
+
+def test_asyncdriversynchedlist_backpressure(total=10, maxsize=2):
+    
+    """
+    Testing producers wait once the worker has maxsize batches queued
+    """
+    
+    worker = IOWorker(maxsize=maxsize)
+    driver = GatedDriver()
+    l = AsyncDriverSynchedList(driver, frequency=1, worker=worker)
+    
+    producer = Thread(target=lambda: [l.append(i) for i in range(total)])
+    producer.start()
+    producer.join(0.2)
+    
+    # The worker is stuck on the first batch, at most maxsize batches are queued
+    assert producer.is_alive()
+    assert worker.queued == maxsize
+    
+    driver.gate.set()
+    producer.join()
+    l.close()
+    worker.stop()
+    
+    assert [item for batch in driver.batches for item in batch] == list(range(total))
+    assert worker.queued == 0
+
+def test_ioworker_stop_race(rounds=200):
+    
+    """
+    Testing requests queued while the worker is stopped are still handled
+    """
+    
+    worker = IOWorker()
+    done = Event()
+    
+    def stopper():
+        while not done.is_set():
+            worker.stop()
+    
+    thread = Thread(target=stopper)
+    thread.start()
+    try:
+        for _ in range(rounds):
+            assert worker.sync(None, None).wait(5)
+    finally:
+        done.set()
+        thread.join()
+    worker.stop()
+
+def test_asyncdriversynchedlist_unclosed_at_exit(total=10, frequency=3):
+    
+    """
+    Testing an async list left unclosed at interpreter exit is written without hanging
+    """
+    
+    file = TESTING_FOLDER / 'unclosed_async_driver_synched_list.json'
+    script = f"""
+from synched_objects.drivers import JsonDriver
+from synched_objects.synched_lists import AsyncDriverSynchedList
+l = AsyncDriverSynchedList(JsonDriver({str(file)!r}, overwrite=True), frequency={frequency})
+for i in range({total}):
+    l.append({{'index': i}})
+"""
+    subprocess.run([sys.executable, '-c', script], check=True, timeout=30,
+                   env={**os.environ, 'PYTHONPATH': os.getcwd()})
+    
+    with open(file, 'rb') as f:
+        assert json.load(f) == [{'index': i} for i in range(total)]
+
+def test_driversynchedlist_sqldriver(frequency=5):
+    
+    """
+    Testing append and extend of synched list using the sql driver
+    """
+    
+    file = TESTING_FOLDER / 'driver_synched_list.db'
+    driver = SQLDriver(file)
+    l = DriverSynchedList(driver, frequency=frequency)
+    
+    data = [{'idx': i, 'value': i/2.} for i in range(12)]
+    l.extend(data[:8])
+    for item in data[8:]:
+        l.append(item)
+    l.flush()
+    
+    assert len(l) == len(data)
+    assert driver.get_data() == data
+    l.close()